@@ -3,7 +3,7 @@ from typing import cast
 
 import discord
 from web3 import AsyncWeb3
-from web3.types import LogReceipt
+from web3.types import EventData
 from web3.contract import AsyncContract
 from web3.contract.async_contract import AsyncContractEvent
 from eth_typing import BlockNumber, HexStr
@@ -11,8 +11,13 @@ from eth_typing import BlockNumber, HexStr
 EL_EXPLORER_URL = 'https://etherscan.io'
 CL_EXPLORER_URL = 'https://beaconcha.in'
 
+def _short(value: str) -> str:
+    return f'{value[:10]}...{value[-8:]}'
+
 class Event(ABC):
-    def __init__(self, w3: AsyncWeb3, vault_name: str, vault_contract: AsyncContract, receipts: list[LogReceipt]):
+    __slots__ = ('w3', 'vault_name', 'vault_contract', 'block', 'tx_idx', 'tx_hash', 'args')
+    
+    def __init__(self, w3: AsyncWeb3, vault_name: str, vault_contract: AsyncContract, receipts: list[EventData]):
         self.w3: AsyncWeb3 = w3
         self.vault_name: str = vault_name
         self.vault_contract: AsyncContract = vault_contract
@@ -23,77 +28,85 @@ class Event(ABC):
         
     @staticmethod
     @abstractmethod
-    def get_contract_event(contract: AsyncContract) -> AsyncContractEvent:
+    def get_contract_event(contract: AsyncContract | type[AsyncContract]) -> AsyncContractEvent:
         pass
     
     @abstractmethod
-    async def to_embed(self) -> discord.Embed | None:
+    async def to_embed(self, timestamp: int) -> discord.Embed | None:
         pass
 
 class Deposit(Event):    
+    __slots__ = ()
+    
     @staticmethod
-    def get_contract_event(contract: AsyncContract) -> AsyncContractEvent:
+    def get_contract_event(contract: AsyncContract | type[AsyncContract]) -> AsyncContractEvent:
         return contract.events.Deposited
     
-    async def to_embed(self) -> discord.Embed:
+    async def to_embed(self, timestamp: int) -> discord.Embed:
         amount = self.w3.from_wei(sum(args['assets'] for args in self.args), 'ether')
         sender = self.args[0]['caller']
-        timestamp = (await self.w3.eth.get_block(self.block)).get('timestamp', 0)
         return discord.Embed(
             title='**New Deposit**', 
             color=discord.Color.green(),
             description=(
                 f'🏦 [{self.vault_name}]({EL_EXPLORER_URL}/address/{self.vault_contract.address})\n'
                 f'💵 **{amount:,.6g} ETH**\n'
-                f'🪪 [{sender[:10]}...{sender[-8:]}]({EL_EXPLORER_URL}/address/{sender})\n'
-                f'🧾 [{self.tx_hash[:10]}...{self.tx_hash[-8:]}]({EL_EXPLORER_URL}/tx/{self.tx_hash})\n'
+                f'🪪 [{_short(sender)}]({EL_EXPLORER_URL}/address/{sender})\n'
+                f'🧾 [{_short(self.tx_hash)}]({EL_EXPLORER_URL}/tx/{self.tx_hash})\n'
                 f'🕒 <t:{timestamp}:R>'
             )
         )
         
 class ExitRequest(Event):        
+    __slots__ = ('shares', 'assets')
+    
+    def __init__(self, w3: AsyncWeb3, vault_name: str, vault_contract: AsyncContract, receipts: list[EventData]):
+        super().__init__(w3, vault_name, vault_contract, receipts)
+        self.shares: int = sum(args['shares'] for args in self.args)
+        self.assets: int | None = None
+        
     @staticmethod
-    def get_contract_event(contract: AsyncContract) -> AsyncContractEvent:
+    def get_contract_event(contract: AsyncContract | type[AsyncContract]) -> AsyncContractEvent:
         return contract.events.ExitQueueEntered
     
-    async def to_embed(self) -> discord.Embed | None:
-        shares = sum(args['shares'] for args in self.args)
-        assets = await self.vault_contract.functions.convertToAssets(shares).call(block_identifier=self.block)
-        amount = self.w3.from_wei(assets, 'ether')
+    async def to_embed(self, timestamp: int) -> discord.Embed | None:
+        if self.assets is None:
+            raise ValueError('Exit request shares have not been converted to assets')
+        amount = self.w3.from_wei(self.assets, 'ether')
         
         if amount < 1:
             return None
         
         sender = self.args[0]['owner']
-        timestamp = (await self.w3.eth.get_block(self.block)).get('timestamp', 0)
         return discord.Embed(
             title='**New Withdrawal**', 
             color=discord.Color.red(),
             description=(
                 f'🏦 [{self.vault_name}]({EL_EXPLORER_URL}/address/{self.vault_contract.address})\n'
                 f'💵 **-{amount:,.6g} ETH**\n'
-                f'🪪 [{sender[:10]}...{sender[-8:]}]({EL_EXPLORER_URL}/address/{sender})\n'
-                f'🧾 [{self.tx_hash[:10]}...{self.tx_hash[-8:]}]({EL_EXPLORER_URL}/tx/{self.tx_hash})\n'
+                f'🪪 [{_short(sender)}]({EL_EXPLORER_URL}/address/{sender})\n'
+                f'🧾 [{_short(self.tx_hash)}]({EL_EXPLORER_URL}/tx/{self.tx_hash})\n'
                 f'🕒 <t:{timestamp}:R>'
             )
         )
         
 class ValidatorRegistration(Event):        
+    __slots__ = ()
+    
     @staticmethod
-    def get_contract_event(contract: AsyncContract) -> AsyncContractEvent:
+    def get_contract_event(contract: AsyncContract | type[AsyncContract]) -> AsyncContractEvent:
         return contract.events.ValidatorRegistered
     
-    async def to_embed(self) -> discord.Embed:
+    async def to_embed(self, timestamp: int) -> discord.Embed:
         pubkeys = ['0x' + args['publicKey'].hex() for args in self.args]
-        timestamp = (await self.w3.eth.get_block(self.block)).get('timestamp', 0)
-        validator_lines = "\n".join(f"📡 [{pubkey[:10]}...{pubkey[-8:]}]({CL_EXPLORER_URL}/validator/{pubkey})" for pubkey in pubkeys)
+        validator_lines = "\n".join(f"📡 [{_short(pubkey)}]({CL_EXPLORER_URL}/validator/{pubkey})" for pubkey in pubkeys)
         return discord.Embed(
             title='**New Validator**' if (len(pubkeys) == 1) else '**New Validators**', 
             color=discord.Color.blue(),
             description=(
                 f'🏦 [{self.vault_name}]({EL_EXPLORER_URL}/address/{self.vault_contract.address})\n'
                 f'{validator_lines}\n'
-                f'🧾 [{self.tx_hash[:10]}...{self.tx_hash[-8:]}]({EL_EXPLORER_URL}/tx/{self.tx_hash})\n'
+                f'🧾 [{_short(self.tx_hash)}]({EL_EXPLORER_URL}/tx/{self.tx_hash})\n'
                 f'🕒 <t:{timestamp}:R>'
             )
         )
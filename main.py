@@ -1,18 +1,28 @@
 import os
-import json
+import time
+import asyncio
 import logging
 import argparse
 from operator import attrgetter
-from typing import Any, Optional, TypeVar, cast
+from collections import OrderedDict, defaultdict
+from contextlib import AbstractAsyncContextManager, nullcontext, suppress
+from typing import Any, Optional, cast
+from urllib.parse import urlparse
 
+import orjson
 import discord
 from discord.abc import Messageable
 from discord.ext import tasks, commands
 
-from web3 import AsyncWeb3
+from web3 import AsyncWeb3, AsyncHTTPProvider, AsyncIPCProvider, PersistentConnectionProvider, WebSocketProvider
+from web3.providers import AsyncBaseProvider
+from web3.types import BlockData, EventData, LogReceipt, RPCResponse, Wei
 from web3.contract import AsyncContract
-from web3._utils.filters import AsyncLogFilter
-from eth_typing import BlockNumber
+from web3.exceptions import ProviderConnectionError, Web3RPCError
+from hexbytes import HexBytes
+from eth_typing import BlockNumber, ChecksumAddress
+from eth_utils import event_abi_to_log_topic
+from websockets.exceptions import ConnectionClosed
 
 from events import Event, Deposit, ExitRequest, ValidatorRegistration
 
@@ -20,107 +30,428 @@ logging.basicConfig(format='%(levelname)5s %(asctime)s [%(name)s] %(message)s')
 logging.getLogger().setLevel('INFO')
 logger = logging.getLogger('StakeWatch')
 
-E = TypeVar('E', bound=Event)
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+BLOCK_CACHE_SIZE = 1024
+FINALIZATION_DEPTH = 64
+UNFINALIZED_BLOCK_TTL = 5.0
+SPARSE_EVENT_COUNT = 100
+MIN_BATCH_SIZE = 10
+FAILED_BATCH_SIZE_EXPIRY = 20
+LOG_RANGE_ERROR_PATTERNS = ('block range', 'range too', 'too many', 'too large', 'more than', 'response size', 'limited to')
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+SUBSCRIPTION_FLUSH_DELAY = 2.0
+
+class OrjsonHTTPProvider(AsyncHTTPProvider):
+    @staticmethod
+    def decode_rpc_response(raw_response: bytes) -> RPCResponse:
+        return cast(RPCResponse, orjson.loads(raw_response))
 
 class StakeWatch(commands.Cog):
     def __init__(self, bot: commands.Bot, cl_args: argparse.Namespace):
         self.bot = bot
-        self.w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(cl_args.rpc))
+        self.w3 = AsyncWeb3(self._get_provider(cl_args.rpc))
+        self.vault_factory = self._get_vault_factory()
         self.vaults = self._get_vaults()
+        self.multicall = self._get_multicall()
+        self.vault_names: dict[ChecksumAddress, str] = {contract.address: name for name, contract in self.vaults.items()}
+        self.event_types: dict[HexBytes, type[Event]] = self._get_event_types()
+        self.batch_lock = asyncio.Lock()
+        self.block_ts_cache: OrderedDict[BlockNumber, tuple[float, asyncio.Future[dict[BlockNumber, int]]]] = OrderedDict()
         self.state: dict[str, Any] = {
             'last_block': 22319339,
             'deposit_threads': {},
         } | (self._load_state() or {})
+        self.saved_block: int = self.state['last_block']
         self.cl_args = cl_args
+        self.batch_size: int = cl_args.batch_size
+        self.failed_batch_size: Optional[int] = None
+        self.full_span_successes: int = 0
         self.event_channel: Messageable = Messageable()
         self.error_channel: Optional[Messageable] = None
+        self.subscription_task: Optional[asyncio.Task[None]] = None
+        # persistent connections report outages differently from HTTP, retry them the same way
+        self.fetch_events.add_exception_type(ProviderConnectionError, ConnectionClosed)
         self.fetch_events.start()
         
+    @staticmethod
+    def _get_provider(rpc: str) -> AsyncBaseProvider:
+        scheme = urlparse(rpc).scheme
+        if scheme in ('http', 'https'):
+            return OrjsonHTTPProvider(rpc)
+        elif scheme in ('ws', 'wss'):
+            return WebSocketProvider(rpc)
+        else:
+            return AsyncIPCProvider(rpc)
+        
+    async def _ensure_connected(self) -> None:
+        provider = self.w3.provider
+        if isinstance(provider, PersistentConnectionProvider) and not await provider.is_connected():
+            # tear down what's left of a dropped connection so stale listener state doesn't leak into the new one
+            with suppress(Exception):
+                await provider.disconnect()
+            await provider.connect()
+        
+    def _get_vault_factory(self) -> type[AsyncContract]:
+        with open('res/vault.abi.json', 'rb') as f:
+            abi = orjson.loads(f.read())
+        return self.w3.eth.contract(abi=abi)
+        
     def _get_vaults(self) -> dict[str, AsyncContract]:
-        with open('res/vaults.json', 'r') as f:
-            vault_addresses = json.load(f)
-        with open('res/vault.abi.json', 'r') as f:
-            abi = f.read()
-        return {name: self.w3.eth.contract(address=addr, abi=abi) for name, addr in vault_addresses.items()}
+        with open('res/vaults.json', 'rb') as f:
+            vault_addresses = orjson.loads(f.read())
+        return {name: self.vault_factory(address=addr) for name, addr in vault_addresses.items()}
+                
+    def _get_multicall(self) -> AsyncContract:
+        with open('res/multicall3.abi.json', 'rb') as f:
+            abi = orjson.loads(f.read())
+        return self.w3.eth.contract(address=MULTICALL3_ADDRESS, abi=abi)
+                
+    def _get_event_types(self) -> dict[HexBytes, type[Event]]:
+        return {
+            HexBytes(event_abi_to_log_topic(event_type.get_contract_event(self.vault_factory).abi)): event_type
+            for event_type in (Deposit, ExitRequest, ValidatorRegistration)
+        }
                 
     def _load_state(self) -> Optional[dict[str, Any]]:
         try:
-            with open('res/state.json', 'r') as f:
-                return json.load(f)
+            with open('res/state.json', 'rb') as f:
+                return orjson.loads(f.read())
         except FileNotFoundError:
             logger.warning('State file not found')
             return None
         
     def _save_state(self, state: dict[str, Any]) -> None:
-        with open('res/state.json', 'w') as f:
-            json.dump(state, f, indent=4)
+        if state['last_block'] == self.saved_block:
+            return
+        
+        # write to a temporary file first so a crash can't leave a truncated state file behind
+        with open('res/state.json.tmp', 'wb') as f:
+            f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace('res/state.json.tmp', 'res/state.json')
+        self.saved_block = state['last_block']
                 
     async def cog_unload(self) -> None:
         self.fetch_events.cancel()
+        if self.subscription_task:
+            self.subscription_task.cancel()
+        if isinstance(self.w3.provider, PersistentConnectionProvider):
+            await self.w3.provider.disconnect()
         
     def on_ready(self) -> None:
         logger.info(f'Logged in as {self.bot.user}')
         
     @tasks.loop(seconds=30)
     async def fetch_events(self) -> None:
+        await self._ensure_connected()
+        caught_up = await self._process_next_range()
+        
+        # persistent connections can have new logs pushed to them once the backlog is processed
+        if caught_up and isinstance(self.w3.provider, PersistentConnectionProvider):
+            logger.info('Caught up to the chain head, switching to log subscription')
+            self.subscription_task = asyncio.create_task(self._subscribe_logs())
+            self.fetch_events.stop()
+            
+    async def _process_next_range(self) -> bool:
         from_block = self.state['last_block'] + 1
         latest_block = await self.w3.eth.block_number
-        to_block = min(latest_block, from_block + self.cl_args.batch_size - 1)
         
-        if to_block < from_block:
+        if latest_block < from_block:
             logger.warning('No new blocks to process')
-            return
+            return True
 
-        logger.info(f'Fetching events in [{from_block}, {to_block}]')
+        to_block, events = await self._get_events_adaptive(from_block, latest_block)
+        await self._process_events(events, latest_block)
         
-        events: list[Event] = []
-        events += await self._get_events_in_range(Deposit, from_block, to_block)
-        events += await self._get_events_in_range(ExitRequest, from_block, to_block)
-        events += await self._get_events_in_range(ValidatorRegistration, from_block, to_block)
+        self.state['last_block'] = to_block
+        self._save_state(self.state)
+        return to_block == latest_block
+    
+    async def _subscribe_logs(self) -> None:
+        subscription_id = None
+        try:
+            subscription_id = await self.w3.eth.subscribe('logs', {
+                'address': list(self.vault_names),
+                'topics': [list(self.event_types)],
+            })
+            # cover blocks produced between the last poll and the subscription becoming active
+            while not await self._process_next_range():
+                pass
+            await self._process_subscription()
+        except Exception as error:
+            # resume polling first so neither the cleanup nor the error report can keep it from restarting
+            logger.warning('Log subscription failed, falling back to polling')
+            if self.fetch_events.is_running():
+                self.fetch_events.restart()
+            else:
+                self.fetch_events.start()
+            with suppress(Exception):
+                await self.on_error(error)
+            if subscription_id is not None:
+                with suppress(Exception):
+                    await self.w3.eth.unsubscribe(subscription_id)
+            
+    async def _process_subscription(self) -> None:
+        stream = self.w3.socket.process_subscriptions()
+        logs: list[LogReceipt] = []
+        while True:
+            # logs are pushed one at a time, collect them until the block is complete
+            try:
+                timeout = SUBSCRIPTION_FLUSH_DELAY if logs else None
+                message = await asyncio.wait_for(anext(stream), timeout)
+            except asyncio.TimeoutError:
+                await self._process_block_logs(logs)
+                logs = []
+                continue
+            except StopAsyncIteration:
+                raise ConnectionError('Log subscription stream closed') from None
+            
+            log = cast(LogReceipt, message['result'])
+            if log.get('removed') or (log['blockNumber'] <= self.state['last_block']):
+                continue
+            if logs and (log['blockNumber'] != logs[-1]['blockNumber']):
+                await self._process_block_logs(logs)
+                logs = []
+            logs.append(log)
+            
+    async def _process_block_logs(self, logs: list[LogReceipt]) -> None:
+        # timestamp and balance lookups run as concurrent batches on the subscription socket, see _batch_guard
+        block = logs[-1]['blockNumber']
+        await self._process_events(self._parse_logs(logs), block)
+        self.state['last_block'] = block
+        self._save_state(self.state)
+        
+    async def _process_events(self, events: list[Event], latest_block: BlockNumber) -> None:
+        timestamps, balances, _ = await asyncio.gather(
+            self._get_block_timestamps([event.block for event in events], latest_block),
+            self._get_vault_balances({(event.vault_contract.address, event.block) for event in events}),
+            self._convert_exit_shares([event for event in events if isinstance(event, ExitRequest)]),
+        )
                                 
-        for event in sorted(events, key=attrgetter('block', 'tx_idx')):
-            embed = await event.to_embed()
+        embeds = await asyncio.gather(*[event.to_embed(timestamps[event.block]) for event in events])
+        
+        # consecutive embeds for the same destination are packed into a single message
+        batch: list[discord.Embed] = []
+        batch_thread_id: Optional[int] = None
+        for event, embed in zip(events, embeds):
             if not embed:
                 continue
             
             vault_address = event.vault_contract.address
-            vault_balance = await self.w3.eth.get_balance(vault_address, block_identifier=event.block)
+            vault_balance = balances[(vault_address, event.block)]
             embed.set_footer(text=f'Vault Balance: {self.w3.from_wei(vault_balance, "ether"):,.2f} ETH')
             
             if isinstance(event, Deposit):
+                await self._send_embeds(batch, batch_thread_id)
+                batch = []
                 message = await self.event_channel.send(embed=embed)
                 thread = await message.create_thread(name='Validator Deposits')
                 self.state['deposit_threads'][vault_address] = thread.id
                 continue
-            elif isinstance(event, ValidatorRegistration):
-                if deposit_thread_id := self.state['deposit_threads'].get(vault_address):
-                    deposit_thread = cast(discord.Thread, await self.bot.fetch_channel(deposit_thread_id))
-                    await deposit_thread.send(embed=embed)
-                    continue
+            
+            thread_id: Optional[int] = None
+            if isinstance(event, ValidatorRegistration):
+                thread_id = self.state['deposit_threads'].get(vault_address)
+                
+            if batch and (
+                (thread_id != batch_thread_id) 
+                or (len(batch) == MAX_EMBEDS_PER_MESSAGE) 
+                or (sum(map(len, batch)) + len(embed) > MAX_EMBED_CHARS_PER_MESSAGE)
+            ):
+                await self._send_embeds(batch, batch_thread_id)
+                batch = []
                 
-            await self.event_channel.send(embed=embed)
+            batch.append(embed)
+            batch_thread_id = thread_id
+            
+        await self._send_embeds(batch, batch_thread_id)
         
-        self.state['last_block'] = to_block
-        self._save_state(self.state)
+    async def _send_embeds(self, embeds: list[discord.Embed], thread_id: Optional[int]) -> None:
+        if not embeds:
+            return
         
-    async def _get_events_in_range(self, event_type: type[E], from_block: BlockNumber, to_block: BlockNumber) -> list[E]:
-        events: list[E] = []
-        for vault_name, vault_contract in self.vaults.items():
-            log_filter: AsyncLogFilter = await event_type.get_contract_event(vault_contract).create_filter(from_block=from_block, to_block=to_block)
-            
-            events_by_tx = {}
-            for receipt in await log_filter.get_all_entries():
-                logger.info(f'New event: {vault_name}: {receipt}')
-                if receipt['transactionHash'] not in events_by_tx:
-                    events_by_tx[receipt['transactionHash']] = []
-                events_by_tx[receipt['transactionHash']].append(receipt)
-                
-            for tx_hash, receipts in events_by_tx.items():
-                event = event_type(self.w3, vault_name, vault_contract, receipts)
-                events.append(event)
+        channel = self.event_channel
+        if thread_id is not None:
+            channel = cast(discord.Thread, await self.bot.fetch_channel(thread_id))
+        await channel.send(embeds=embeds)
+        
+    async def _get_events_adaptive(self, from_block: BlockNumber, latest_block: BlockNumber) -> tuple[BlockNumber, list[Event]]:
+        while True:
+            to_block = cast(BlockNumber, min(latest_block, from_block + self.batch_size - 1))
+            logger.info(f'Fetching events in [{from_block}, {to_block}]')
+            try:
+                events = await self._get_events_in_range(from_block, to_block)
+                break
+            except (Web3RPCError, asyncio.TimeoutError) as error:
+                span = to_block - from_block + 1
+                full_span = (span == self.batch_size)
+                if (span <= MIN_BATCH_SIZE) or not self._is_range_error(error, full_span):
+                    raise
+                # only an explicit rejection of a full range says anything about the node's limit,
+                # short ranges near the chain head and timeouts are not evidence of one
+                if full_span and isinstance(error, Web3RPCError):
+                    self.failed_batch_size = min(span, self.failed_batch_size or span)
+                self.full_span_successes = 0
+                self.batch_size = max(MIN_BATCH_SIZE, min(span, self.batch_size) // 2)
+                logger.warning(f'Failed to fetch events, reducing batch size to {self.batch_size}')
                 
+        if to_block - from_block + 1 == self.batch_size:
+            self.full_span_successes += 1
+            if self.full_span_successes >= FAILED_BATCH_SIZE_EXPIRY:
+                # node limits can be raised and some failures are transient, so probe the old limit again
+                self.failed_batch_size = None
+                self.full_span_successes = 0
+            if len(events) < SPARSE_EVENT_COUNT:
+                self.batch_size = min(self._grow_batch_size(), self.cl_args.max_batch_size)
+            
+        return to_block, events
+    
+    def _grow_batch_size(self) -> int:
+        if self.failed_batch_size is None:
+            return 2 * self.batch_size
+        # approach a range the node has rejected before gradually instead of doubling straight back into it
+        return max(self.batch_size, min(2 * self.batch_size, (self.batch_size + self.failed_batch_size) // 2))
+    
+    @staticmethod
+    def _is_range_error(error: Exception, full_span: bool) -> bool:
+        # a timeout on a full range may be an oversized response, on a shorter one it is just a slow node
+        if isinstance(error, asyncio.TimeoutError):
+            return full_span
+        message = str(error).lower()
+        return any(pattern in message for pattern in LOG_RANGE_ERROR_PATTERNS)
+        
+    async def _get_events_in_range(self, from_block: BlockNumber, to_block: BlockNumber) -> list[Event]:
+        logs = await self.w3.eth.get_logs({
+            'address': list(self.vault_names),
+            'topics': [list(self.event_types)],
+            'fromBlock': from_block,
+            'toBlock': to_block,
+        })
+        return self._parse_logs(logs)
+    
+    def _parse_logs(self, logs: list[LogReceipt]) -> list[Event]:
+        self._cache_log_timestamps(logs)
+        
+        events_by_tx: defaultdict[tuple[type[Event], ChecksumAddress, HexBytes], list[EventData]] = defaultdict(list)
+        for log in logs:
+            event_type = self.event_types[log['topics'][0]]
+            receipt = event_type.get_contract_event(self.vault_factory).process_log(log)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Log: {receipt}')
+            events_by_tx[(event_type, log['address'], receipt['transactionHash'])].append(receipt)
+            
+        events: list[Event] = []
+        for (event_type, vault_address, tx_hash), receipts in events_by_tx.items():
+            vault_name = self.vault_names[vault_address]
+            logger.info(f'New event: {vault_name}: {event_type.__name__} in {tx_hash.to_0x_hex()}')
+            event = event_type(self.w3, vault_name, self.vaults[vault_name], receipts)
+            events.append(event)
+        
+        # logs arrive in chain order, so this is a linear pass that only guards against out-of-order responses
+        events.sort(key=attrgetter('block', 'tx_idx'))
         return events
         
+    def _cache_log_timestamps(self, logs: list[LogReceipt]) -> None:
+        # nodes implementing the current execution API spec include the block timestamp in each log,
+        # which saves a block lookup for every block with events
+        timestamps: dict[BlockNumber, int] = {}
+        for log in logs:
+            if (timestamp := log.get('blockTimestamp')) is not None:
+                timestamps[log['blockNumber']] = int(timestamp, 16) if isinstance(timestamp, str) else timestamp
+        
+        if not timestamps:
+            return
+        
+        future: asyncio.Future[dict[BlockNumber, int]] = asyncio.get_running_loop().create_future()
+        future.set_result(timestamps)
+        now = time.monotonic()
+        for block in timestamps:
+            self._cache_block_timestamp(block, future, now)
+    
+    async def _get_block_timestamps(self, blocks: list[BlockNumber], latest_block: BlockNumber) -> dict[BlockNumber, int]:
+        now = time.monotonic()
+        pending: dict[BlockNumber, asyncio.Future[dict[BlockNumber, int]]] = {}
+        missing: list[BlockNumber] = []
+        for block in sorted(set(blocks)):
+            finalized = block <= latest_block - FINALIZATION_DEPTH
+            if (entry := self.block_ts_cache.get(block)) and (finalized or now - entry[0] < UNFINALIZED_BLOCK_TTL):
+                self.block_ts_cache.move_to_end(block)
+                pending[block] = entry[1]
+            else:
+                missing.append(block)
+        
+        if missing:
+            # cache the inflight request so concurrent lookups of the same blocks share it
+            task = asyncio.create_task(self._fetch_block_timestamps(missing))
+            task.add_done_callback(lambda t: self._discard_failed_lookup(t, missing))
+            for block in missing:
+                self._cache_block_timestamp(block, task, now)
+                pending[block] = task
+                
+        return {block: (await future)[block] for block, future in pending.items()}
+    
+    def _cache_block_timestamp(self, block: BlockNumber, future: asyncio.Future[dict[BlockNumber, int]], fetched_at: float) -> None:
+        self.block_ts_cache[block] = (fetched_at, future)
+        self.block_ts_cache.move_to_end(block)
+        while len(self.block_ts_cache) > BLOCK_CACHE_SIZE:
+            self.block_ts_cache.popitem(last=False)
+    
+    def _discard_failed_lookup(self, task: asyncio.Task[dict[BlockNumber, int]], blocks: list[BlockNumber]) -> None:
+        if not task.cancelled() and task.exception() is None:
+            return
+        for block in blocks:
+            if (entry := self.block_ts_cache.get(block)) and entry[1] is task:
+                del self.block_ts_cache[block]
+    
+    async def _fetch_block_timestamps(self, blocks: list[BlockNumber]) -> dict[BlockNumber, int]:
+        async with self._batch_guard(), self.w3.batch_requests() as batch:
+            for block in blocks:
+                batch.add(self.w3.eth.get_block(block))
+            results = cast(list[BlockData], await batch.async_execute())
+            
+        return {block: data.get('timestamp', 0) for block, data in zip(blocks, results)}
+    
+    def _batch_guard(self) -> AbstractAsyncContextManager[Any]:
+        # persistent providers file every batch response under the same request id,
+        # so concurrent batches on one connection can receive each other's results
+        if isinstance(self.w3.provider, PersistentConnectionProvider):
+            return self.batch_lock
+        return nullcontext()
+    
+    async def _get_vault_balances(self, vault_blocks: set[tuple[ChecksumAddress, BlockNumber]]) -> dict[tuple[ChecksumAddress, BlockNumber], Wei]:
+        if not vault_blocks:
+            return {}
+        
+        keys = list(vault_blocks)
+        async with self._batch_guard(), self.w3.batch_requests() as batch:
+            for vault_address, block in keys:
+                batch.add(self.w3.eth.get_balance(vault_address, block_identifier=block))
+            results = cast(list[Wei], await batch.async_execute())
+            
+        return dict(zip(keys, results))
+        
+    async def _convert_exit_shares(self, exit_requests: list[ExitRequest]) -> None:
+        requests_by_block: defaultdict[BlockNumber, list[ExitRequest]] = defaultdict(list)
+        for exit_request in exit_requests:
+            requests_by_block[exit_request.block].append(exit_request)
+            
+        await asyncio.gather(*[
+            self._convert_exit_shares_at_block(block, block_requests) 
+            for block, block_requests in requests_by_block.items()
+        ])
+        
+    async def _convert_exit_shares_at_block(self, block: BlockNumber, exit_requests: list[ExitRequest]) -> None:
+        calls = [{
+            'target': exit_request.vault_contract.address,
+            'allowFailure': False,
+            'callData': exit_request.vault_contract.encode_abi('convertToAssets', args=[exit_request.shares]),
+        } for exit_request in exit_requests]
+        results = await self.multicall.functions.aggregate3(calls).call(block_identifier=block)
+        for exit_request, (_, return_data) in zip(exit_requests, results):
+            exit_request.assets = self.w3.codec.decode(['uint256'], return_data)[0]
+        
     @fetch_events.before_loop
     async def setup(self) -> None:
         await self.bot.wait_until_ready()
@@ -137,10 +468,11 @@ class StakeWatch(commands.Cog):
         
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(prog='stakewatch')
-    parser.add_argument('-r', '--rpc', type=str, help='Ethereum RPC URL', required=True)
+    parser.add_argument('-r', '--rpc', type=str, help='Ethereum RPC URL (HTTP, WebSocket or IPC socket path)', required=True)
     parser.add_argument('-c', '--channel', type=int, help='Discord channel ID for events', required=True)
     parser.add_argument('-e', '--errors', type=int, help='Discord channel ID for error reporting', required=False)
-    parser.add_argument('--batch-size', type=int, help='Maximum number of processed blocks per iteration', default=10_000)
+    parser.add_argument('--batch-size', type=int, help='Initial number of processed blocks per iteration', default=10_000)
+    parser.add_argument('--max-batch-size', type=int, help='Maximum number of processed blocks per iteration', default=100_000)
     return parser.parse_args()
 
 